@@ -1,34 +1,156 @@
-import uuid
 import json
 import os
 import io
-import base64
-import qrcode
-from flask import Flask, request, jsonify, render_template, redirect, url_for, send_from_directory
+import functools
+import hashlib
+import mimetypes
+import queue
+import secrets
+import shutil
+import tempfile
+import threading
+import time
+import orjson
+import segno
+from urllib.parse import quote
+from flask import Flask, Request, request, jsonify, render_template, redirect, url_for, send_from_directory, abort
+from flask.json.provider import DefaultJSONProvider
+from jinja2 import FileSystemBytecodeCache
 # Note: Database imports are relative, relying on database.py
-from database import init_db, store_label_data, get_label_data, get_all_label_summaries, delete_label_data
-from werkzeug.utils import secure_filename
+from database import (
+    init_db, store_label_data, store_label_data_bulk, get_exhibit_plus_sidebar,
+    delete_label_data, is_media_referenced, get_label_qrcode, store_label_qrcode
+)
+from werkzeug.security import safe_join
 
 # --- Configuration ---
 UPLOADS_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'mp3', 'wav'}
+UPLOAD_MEMORY_LIMIT = 4 * 1024 * 1024 # Uploads up to this size never touch a temp file
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# A deduplicated upload may be handed out again before any label references it,
+# so cleanup of a file is postponed until this long after it was last uploaded
+UPLOAD_REUSE_GRACE_SECONDS = 60 * 60
+# Behind nginx, set this to an internal location so nginx sends upload bytes itself:
+#   location /_internal_uploads/ { internal; alias /home/ubuntu/flaskapp/uploads/; }
+UPLOADS_ACCEL_REDIRECT = os.environ.get('UPLOADS_ACCEL_REDIRECT') # e.g. '/_internal_uploads/'
+# Public address QR codes point at. Without it the request's Host header is used,
+# which differs between IP/domain and http/https and is client-controlled.
+EXTERNAL_BASE_URL = os.environ.get('EXTERNAL_BASE_URL') # e.g. 'https://exhibits.example.org'
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Routes jsonify() (and any request.get_json() caller) through orjson instead of stdlib json."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            # orjson rejects NaN, Infinity and out-of-range numbers like 1e400, which stdlib json accepts
+            return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype=self.mimetype)
+
+class UploadRequest(Request):
+    """Keeps small uploads in memory instead of Werkzeug's 500KB spool threshold."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=UPLOAD_MEMORY_LIMIT, mode='rb+')
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+app.request_class = UploadRequest
 app.config['UPLOADS_FOLDER'] = UPLOADS_FOLDER
+app.config['UPLOADS_ACCEL_REDIRECT'] = UPLOADS_ACCEL_REDIRECT
+app.config['EXTERNAL_BASE_URL'] = EXTERNAL_BASE_URL
+# Behind Apache with mod_xsendfile, send_from_directory emits X-Sendfile instead of the body
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
 os.makedirs(UPLOADS_FOLDER, exist_ok=True)
 
 # Initialize the database when the app starts
 init_db(app)
 
+def warm_templates(app):
+    """Compiles every template up front so no visitor pays Jinja's compile cost."""
+    # Compiled bytecode is also kept on disk so restarted workers skip compilation.
+    # Jinja's default directory is private to this uid (0700, ownership checked),
+    # so other local users can't plant bytecode for it to load.
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+warm_templates(app)
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def _upload_fileno(stream):
+    """Returns the OS file descriptor behind an upload stream, or None if it is held in memory."""
+    # Calling fileno() on an unrolled spool would force it onto disk first
+    if isinstance(stream, tempfile.SpooledTemporaryFile) and not stream._rolled:
+        return None
+    try:
+        return stream.fileno()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return None
+
+def hash_upload(stream):
+    """Returns a content digest of an upload stream and rewinds it."""
+    digest = hashlib.blake2b(digest_size=16)
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+def save_upload(file, filepath):
+    """Streams an uploaded file to disk, using sendfile when it is already backed by a real file."""
+    src_fd = _upload_fileno(file.stream)
+    dst_fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    with open(dst_fd, 'wb') as dst:
+        if src_fd is not None and hasattr(os, 'sendfile'):
+            # Kernel-side copy from the spooled temp file, no userspace buffers
+            size = os.fstat(src_fd).st_size
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        else:
+            file.stream.seek(0)
+            shutil.copyfileobj(file.stream, dst, length=UPLOAD_CHUNK_SIZE)
+
+def read_json_body():
+    """Parses the raw request body with orjson, skipping get_json()'s content-type checks and body cache.
+
+    Returns None when the body is empty or not valid JSON.
+    """
+    body = request.get_data(cache=False)
+    try:
+        return orjson.loads(body)
+    except orjson.JSONDecodeError:
+        pass
+    try:
+        # orjson rejects NaN, Infinity and out-of-range numbers like 1e400, which get_json() accepted
+        return json.loads(body)
+    except ValueError:
+        return None
+
+def generate_label_id():
+    # 4 random bytes hex-encoded, same 8-char shape as the old uuid4 prefix
+    return secrets.token_hex(4)
+
 # ----------------------------------------------------
-# 2. File Upload Handling (No changes needed here, keeping for context)
+# 2. File Upload Handling (content-addressed, deduplicated storage)
 # ----------------------------------------------------
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
-    # ... (existing file upload logic)
+    """Stores an uploaded media file under its content hash and returns its URL."""
     if 'file' not in request.files:
         return jsonify({"error": "No file part in the request"}), 400
     
@@ -38,12 +160,23 @@ def upload_file():
         return jsonify({"error": "No selected file"}), 400
     
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4().hex}_{filename}"
+        # Content-addressed name: re-uploading the same bytes reuses the stored file
+        extension = file.filename.rsplit('.', 1)[1].lower()
+        unique_filename = f"{hash_upload(file.stream)}.{extension}"
         filepath = os.path.join(app.config['UPLOADS_FOLDER'], unique_filename)
         
         try:
-            file.save(filepath)
+            if os.path.exists(filepath):
+                os.utime(filepath) # Restart the cleanup grace period
+            else:
+                temp_path = f"{filepath}.{secrets.token_hex(4)}.tmp"
+                try:
+                    save_upload(file, temp_path)
+                    os.replace(temp_path, filepath) # Atomic on the same filesystem
+                except BaseException:
+                    if os.path.exists(temp_path):
+                        os.unlink(temp_path)
+                    raise
             # print(f"SUCCESS: File saved to {os.path.abspath(filepath)}") # Existing log is helpful
         except Exception as e:
             print(f"CRITICAL ERROR: Failed to save file at path {os.path.abspath(filepath)}. Error: {e}") 
@@ -59,6 +192,14 @@ def upload_file():
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
+    accel_prefix = app.config['UPLOADS_ACCEL_REDIRECT']
+    if accel_prefix:
+        if safe_join(app.config['UPLOADS_FOLDER'], filename) is None:
+            abort(404)
+        # The worker only returns headers; nginx streams the file from its internal location
+        response = app.response_class(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = f"{accel_prefix.rstrip('/')}/{quote(filename)}"
+        return response
     return send_from_directory(app.config['UPLOADS_FOLDER'], filename)
 
 # ----------------------------------------------------
@@ -68,14 +209,15 @@ def uploaded_file(filename):
 def create_label():
     """Receives JSON data, stores it, and returns the unique URL."""
     try:
-        data = request.get_json()
-        if not data:
+        data = read_json_body()
+        if not data or not isinstance(data, dict):
             return jsonify({"error": "No JSON data provided in request body."}), 400
 
-        label_id = str(uuid.uuid4())[:8]
+        label_id = generate_label_id()
 
         # CRITICAL STEP: Call the function that tries to write to the DB
-        store_label_data(label_id, data) 
+        if not store_label_data(label_id, data):
+            return jsonify({"error": "Could not save the label."}), 500
 
         label_url = url_for('unified_exhibit_site', label_id=label_id)
 
@@ -90,41 +232,115 @@ def create_label():
         print(f"ERROR during label creation (likely DB issue): {e}")
         return jsonify({"error": f"Internal server error: {e}"}), 500
         
+@app.route('/api/create_labels', methods=['POST'])
+def create_labels():
+    """Receives a JSON array of label data, stores it in one transaction, and returns the unique URLs."""
+    try:
+        data = read_json_body()
+        if not data or not isinstance(data, list):
+            return jsonify({"error": "Expected a non-empty JSON array of label data."}), 400
+        if not all(isinstance(item, dict) and item for item in data):
+            return jsonify({"error": "Every label in the array must be a non-empty JSON object."}), 400
+
+        pairs = [(generate_label_id(), item) for item in data]
+
+        if not store_label_data_bulk(pairs):
+            return jsonify({"error": "Could not save the labels."}), 500
+
+        labels = [
+            {"label_id": label_id, "url": url_for('unified_exhibit_site', label_id=label_id)}
+            for label_id, _ in pairs
+        ]
+
+        print(f"--- SUCCESS: {len(labels)} labels created. ---")
+        return jsonify({
+            "message": f"{len(labels)} exhibit labels successfully saved.",
+            "labels": labels
+        }), 201
+
+    except Exception as e:
+        print(f"ERROR during bulk label creation (likely DB issue): {e}")
+        return jsonify({"error": f"Internal server error: {e}"}), 500
+
 # ----------------------------------------------------
 # 4. Label Deletion and QR Code Generation (Keeping existing logic)
 # ----------------------------------------------------
+# Orphaned uploads are unlinked off the request thread so DELETE responses never wait on the filesystem
+_media_cleanup_queue = queue.Queue()
+
+def _remove_orphaned_media(filename):
+    filepath = safe_join(app.config['UPLOADS_FOLDER'], filename)
+    if not filepath:
+        return
+    try:
+        age = time.time() - os.stat(filepath).st_mtime
+        if age < UPLOAD_REUSE_GRACE_SECONDS:
+            # Too fresh to remove yet; queue it again once the grace period is over
+            retry = threading.Timer(UPLOAD_REUSE_GRACE_SECONDS - age, _media_cleanup_queue.put, args=(filename,))
+            retry.daemon = True
+            retry.start()
+            return
+        # A label created after the delete may already point at this file again
+        if is_media_referenced(filename):
+            return
+        os.unlink(filepath)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"ERROR: Failed to delete media file {filename}. Error: {e}")
+
+def _media_cleanup_worker():
+    while True:
+        filename = _media_cleanup_queue.get()
+        try:
+            _remove_orphaned_media(filename)
+        finally:
+            _media_cleanup_queue.task_done()
+
+threading.Thread(target=_media_cleanup_worker, name='media-cleanup', daemon=True).start()
+
 @app.route('/api/delete_label/<label_id>', methods=['DELETE'])
 def delete_label(label_id):
-    success = delete_label_data(label_id)
-    if success:
+    orphaned_media = delete_label_data(label_id)
+    if orphaned_media is not None:
+        for filename in orphaned_media:
+            _media_cleanup_queue.put(filename)
         return jsonify({"message": f"Label {label_id} deleted successfully."}), 200
     else:
         return jsonify({"error": f"Could not delete label {label_id}."}), 404
 
 def generate_qrcode_base64(url):
-    qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=4)
-    qr.add_data(url)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
-    img_b64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-    return f"data:image/png;base64,{img_b64}"
+    # segno writes the PNG and its base64 data URI in one pass, no PIL image in between
+    qr = segno.make(url, error='l', micro=False)
+    return qr.png_data_uri(scale=10, border=4)
+
+@functools.lru_cache(maxsize=256)
+def label_qrcode(label_id, url):
+    """Returns a label's QR code, checking the in-process cache, then the database, before rendering."""
+    stored_url, stored_image = get_label_qrcode(label_id)
+    if stored_url == url and stored_image is not None:
+        return stored_image
+    qr_code_image = generate_qrcode_base64(url)
+    # A code stored for another host stays put; this one is only cached in memory
+    if stored_image is None:
+        store_label_qrcode(label_id, url, qr_code_image)
+    return qr_code_image
 
 # ----------------------------------------------------
 # 5. Unified Site Structure (The New Viewer)
 # ----------------------------------------------------
 @app.route('/exhibit/<label_id>')
 def unified_exhibit_site(label_id):
-    label_data = get_label_data(label_id) # This is the failed fetch call
+    label_data, all_exhibits = get_exhibit_plus_sidebar(label_id)
     
     if not label_data:
         # Returns the 404 error you saw
         return render_template('error_404.html', label_id=label_id), 404
 
-    all_exhibits = get_all_label_summaries()
-    full_url = url_for('unified_exhibit_site', label_id=label_id, _external=True)
-    qr_code_image = generate_qrcode_base64(full_url)
+    # Both bases already carry scheme, host and any script root, so skip the URL adapter
+    base_url = app.config['EXTERNAL_BASE_URL'] or request.url_root
+    full_url = f"{base_url.rstrip('/')}/exhibit/{label_id}"
+    qr_code_image = label_qrcode(label_id, full_url)
     template_type = label_data.get('template', 'minimalist')
     
     return render_template(
@@ -141,4 +357,6 @@ def page_not_found(e):
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # Development only; production runs under gunicorn (see gunicorn.conf.py).
+    # The debug reloader is opt-in because it stat()s every module on a loop.
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1')
\ No newline at end of file
@@ -1,114 +1,554 @@
-import sqlite3
 import json
+import sqlite3
+import threading
+from collections import OrderedDict
 from sqlite3 import Connection, Error
+from urllib.parse import urlsplit
+
+import orjson
+import zstandard
 
 DATABASE_FILE = 'labels.db'
+LABEL_CACHE_SIZE = 512
+LABEL_COMPRESSION_LEVEL = 3
+MEDIA_URL_PREFIX = '/uploads/' # mediaUrl values under this path are files we own
+
+# Each worker thread keeps one long-lived connection instead of reconnecting per call
+_local = threading.local()
+
+# Label rows never change after insert, so their decompressed JSON can be kept
+# in an LRU keyed by ID and evicted only when that ID is written or deleted. Writes
+# from other connections are caught by _sync_caches; the generation counter
+# stops a read that raced with an eviction from caching a stale label.
+_label_cache = OrderedDict()
+_label_generation = 0
+_label_cache_lock = threading.Lock()
+
+# The sidebar summary list only changes on insert/delete, here or in another
+# process (see _sync_caches). The generation counter stops a read that raced
+# with a write from caching a stale list.
+_summaries_cache = None
+_summaries_generation = 0
+_summaries_lock = threading.Lock()
+
+# Connection used only to watch PRAGMA data_version, and the last value seen on it
+_version_conn = None
+_data_version = None
+_version_lock = threading.Lock()
+
+def _evict_label(label_id: str):
+    global _label_generation, _summaries_cache, _summaries_generation
+    with _label_cache_lock:
+        _label_cache.pop(label_id, None)
+        _label_generation += 1
+    with _summaries_lock:
+        _summaries_cache = None
+        _summaries_generation += 1
+
+def _clear_caches():
+    """Drops every cached label and the cached summary list."""
+    global _label_generation, _summaries_cache, _summaries_generation
+    with _label_cache_lock:
+        _label_cache.clear()
+        _label_generation += 1
+    with _summaries_lock:
+        _summaries_cache = None
+        _summaries_generation += 1
+
+def _sync_caches():
+    """Clears the in-process caches if any connection has committed since the last check.
+
+    PRAGMA data_version only means something compared with an earlier value
+    from the same connection, so the whole process reads it from one shared,
+    read-only connection. That keeps the caches warm across threads (the dev
+    server starts a new one per request) and catches commits from other worker
+    processes. This process's own commits bump it too, which costs an extra
+    clear after a write but never serves stale data.
+    """
+    global _version_conn, _data_version
+    with _version_lock:
+        if _version_conn is None:
+            _version_conn = sqlite3.connect(DATABASE_FILE, check_same_thread=False, isolation_level=None)
+        version = _version_conn.execute(_SQL_DATA_VERSION).fetchone()[0]
+        if version != _data_version:
+            # Cleared under the lock so no other thread sees the new version first
+            _data_version = version
+            _clear_caches()
+
+def _zstd_contexts() -> tuple:
+    """Returns this thread's zstd (compressor, decompressor); the contexts are not thread-safe."""
+    contexts = getattr(_local, 'zstd', None)
+    if contexts is None:
+        contexts = (
+            zstandard.ZstdCompressor(level=LABEL_COMPRESSION_LEVEL),
+            zstandard.ZstdDecompressor()
+        )
+        _local.zstd = contexts
+    return contexts
+
+def _encode_label(data: dict) -> bytes:
+    """Serializes a label to zstd-compressed JSON for the data column."""
+    # Compressed rows stay small enough to avoid SQLite overflow pages
+    return _zstd_contexts()[0].compress(orjson.dumps(data))
+
+def _label_json(stored) -> bytes:
+    """Returns the plain JSON bytes of a data column value, accepting rows stored before compression."""
+    if isinstance(stored, str):
+        return stored.encode('utf-8')
+    return _zstd_contexts()[1].decompress(stored)
+
+def _loads_label(label_json: bytes):
+    """Decodes label JSON, falling back to stdlib json for NaN/Infinity, which older rows may contain."""
+    try:
+        return orjson.loads(label_json)
+    except orjson.JSONDecodeError:
+        return json.loads(label_json)
 
 def get_db_connection() -> Connection:
-    """Creates and returns a connection to the SQLite database."""
-    conn = None
+    """Returns this thread's persistent connection to the SQLite database."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        return conn
     try:
-        conn = sqlite3.connect(DATABASE_FILE)
+        # isolation_level=None puts the connection in autocommit mode
+        conn = sqlite3.connect(DATABASE_FILE, check_same_thread=False, isolation_level=None)
         conn.row_factory = sqlite3.Row # Allows fetching rows as dictionaries
+        # These pragmas are per-connection, so every thread's connection needs
+        # them; they trade durability-on-power-loss for fewer fsyncs
+        conn.executescript("""
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA mmap_size=268435456;
+            PRAGMA cache_size=-20000;
+        """)
+        _local.conn = conn
         return conn
     except Error as e:
         print(f"Error connecting to database: {e}")
         return None
 
+# WITHOUT ROWID stores each row inside the primary-key B-tree, so an ID
+# lookup is a single descent instead of index probe + rowid fetch
+_LABELS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {table} (
+        id TEXT PRIMARY KEY,
+        data BLOB NOT NULL,
+        title TEXT,
+        template TEXT,
+        qr_url TEXT,
+        qr_png TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID;
+"""
+_LABELS_COLUMNS = "id, data, title, template, qr_url, qr_png, created_at"
+
+# Hot-path statements live here so every call site passes the identical SQL
+# text, letting the per-connection sqlite3 statement cache skip re-preparing them
+_SQL_DATA_VERSION = "PRAGMA data_version"
+_SQL_INSERT = "INSERT INTO labels (id, data, title, template) VALUES (?, ?, ?, ?)"
+_SQL_SELECT = "SELECT data FROM labels WHERE id = ?"
+_SQL_SELECT_QR = "SELECT qr_url, qr_png FROM labels WHERE id = ?"
+# Only the first rendered code is kept, so requests arriving under other hosts can't keep rewriting it
+_SQL_UPDATE_QR = "UPDATE labels SET qr_url = ?, qr_png = ? WHERE id = ? AND qr_png IS NULL"
+_SQL_SUMMARY_SELECT = "SELECT id, title, template FROM labels ORDER BY created_at DESC"
+_SQL_DELETE = "DELETE FROM labels WHERE id = ?"
+# Sidebar rows plus the current label's data in one ordered scan; data is NULL on every other row
+_SQL_EXHIBIT_PLUS_SIDEBAR = """
+    SELECT id, title, template, CASE WHEN id = ?1 THEN data END AS data
+    FROM labels ORDER BY created_at DESC
+"""
+_SQL_INSERT_MEDIA = "INSERT OR IGNORE INTO label_media (label_id, filename) VALUES (?, ?)"
+# Files that no other label still references, so deleting this label may unlink them
+_SQL_SELECT_ORPHANED_MEDIA = """
+    SELECT filename FROM label_media
+    WHERE label_id = ?
+      AND filename NOT IN (SELECT filename FROM label_media WHERE label_id != ?)
+"""
+_SQL_DELETE_MEDIA = "DELETE FROM label_media WHERE label_id = ?"
+_SQL_MEDIA_REFERENCED = "SELECT 1 FROM label_media WHERE filename = ? LIMIT 1"
+
+def _migrate_columns(conn: Connection):
+    """Adds columns missing from older databases and backfills title/template."""
+    columns = {row['name'] for row in conn.execute("PRAGMA table_info(labels)")}
+    for column in ('title', 'template', 'qr_url', 'qr_png'):
+        if column not in columns:
+            conn.execute(f"ALTER TABLE labels ADD COLUMN {column} TEXT")
+    # Decoded in Python rather than with json_extract, which rejects the
+    # NaN/Infinity that stdlib json wrote into older rows
+    updates = []
+    rows = conn.execute(
+        "SELECT id, data FROM labels WHERE title IS NULL OR template IS NULL"
+    ).fetchall()
+    for row in rows:
+        try:
+            data = _loads_label(_label_json(row['data']))
+        except (ValueError, zstandard.ZstdError) as e:
+            print(f"Undecodable data for ID {row['id']}, using sidebar defaults: {e}")
+            data = None
+        if not isinstance(data, dict):
+            data = {}
+        updates.append((
+            _text_column(data.get('projectTitle'), 'Untitled Project'),
+            _text_column(data.get('template'), 'minimalist'),
+            row['id']
+        ))
+    conn.executemany("UPDATE labels SET title = ?, template = ? WHERE id = ?", updates)
+
+def _cluster_by_id(conn: Connection):
+    """Rebuilds a rowid 'labels' table from an older database as WITHOUT ROWID."""
+    row = conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'labels'"
+    ).fetchone()
+    if 'WITHOUT ROWID' in row['sql'].upper():
+        return
+    conn.execute(_LABELS_TABLE_SQL.format(table='labels_clustered'))
+    conn.execute(
+        f"INSERT INTO labels_clustered ({_LABELS_COLUMNS}) SELECT {_LABELS_COLUMNS} FROM labels"
+    )
+    conn.execute("DROP TABLE labels")
+    conn.execute("ALTER TABLE labels_clustered RENAME TO labels")
+
+def _create_media_table(conn: Connection):
+    """Creates the label_media table, backfilling it from existing labels the first time."""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'label_media'"
+    ).fetchone()
+    if exists:
+        return
+    conn.execute("""
+        CREATE TABLE label_media (
+            label_id TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            PRIMARY KEY (label_id, filename)
+        ) WITHOUT ROWID;
+    """)
+    conn.execute("CREATE INDEX idx_label_media_filename ON label_media (filename)")
+    # Extracted in Python with the same rule new inserts use, so absolute
+    # media URLs are recorded too
+    pairs = []
+    for row in conn.execute("SELECT id, data FROM labels").fetchall():
+        try:
+            data = _loads_label(_label_json(row['data']))
+        except (ValueError, zstandard.ZstdError) as e:
+            print(f"Undecodable data for ID {row['id']}, no media recorded: {e}")
+            continue
+        if isinstance(data, dict):
+            pairs.extend((row['id'], filename) for filename in _media_filenames(data))
+    conn.executemany(_SQL_INSERT_MEDIA, pairs)
+
+def _compress_label_data(conn: Connection):
+    """Rewrites plain-text JSON rows from older databases as compressed blobs."""
+    rows = conn.execute("SELECT id, data FROM labels WHERE typeof(data) = 'text'").fetchall()
+    if not rows:
+        return
+    # The text is compressed verbatim rather than re-encoded, so rows orjson
+    # can't parse (NaN/Infinity from stdlib json) keep their exact contents
+    compressor = _zstd_contexts()[0]
+    conn.executemany(
+        "UPDATE labels SET data = ? WHERE id = ?",
+        [(compressor.compress(row['data'].encode('utf-8')), row['id']) for row in rows]
+    )
+
 def init_db(app):
     """Initializes the database and creates the necessary table."""
     with app.app_context():
         conn = get_db_connection()
         if conn:
             try:
+                # WAL lets readers and the writer proceed concurrently; unlike
+                # the other pragmas it is stored in the database file itself
+                conn.execute("PRAGMA journal_mode=WAL")
+                # Every server worker runs this at import. One IMMEDIATE
+                # transaction makes the schema work atomic and lets a single
+                # worker migrate while the others wait, then find nothing to do.
+                conn.execute("BEGIN IMMEDIATE")
                 # Create the 'labels' table if it doesn't exist
-                conn.execute("""
-                    CREATE TABLE IF NOT EXISTS labels (
-                        id TEXT PRIMARY KEY,
-                        data TEXT NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    );
-                """)
-                conn.commit()
+                conn.execute(_LABELS_TABLE_SQL.format(table='labels'))
+                _migrate_columns(conn)
+                _cluster_by_id(conn)
+                _create_media_table(conn)
+                _compress_label_data(conn)
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_labels_created_at ON labels (created_at)"
+                )
+                conn.execute("COMMIT")
                 print(f"Database initialized: {DATABASE_FILE}")
             except Error as e:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
                 print(f"Error initializing table: {e}")
-            finally:
-                conn.close()
+                # Serving against a half-migrated schema would fail every write
+                raise
 
-def store_label_data(label_id: str, data: dict):
+def _text_column(value, default: str) -> str:
+    """Coerces a label field to TEXT; explicit nulls get the default so the column is never NULL."""
+    if value is None:
+        return default
+    # Non-string JSON (objects, numbers) would fail to bind; store what the template would print
+    return value if isinstance(value, str) else str(value)
+
+def _label_row(label_id: str, data: dict) -> tuple:
+    """Builds the INSERT parameters for one label."""
+    # Sidebar fields get their own columns so summaries never parse the JSON
+    return (
+        label_id,
+        _encode_label(data),
+        _text_column(data.get('projectTitle'), 'Untitled Project'),
+        _text_column(data.get('template'), 'minimalist')
+    )
+
+def _media_filenames(data: dict) -> set:
+    """Extracts the uploaded filenames a label's exhibits point at."""
+    filenames = set()
+    exhibits = data.get('exhibits')
+    if not isinstance(exhibits, list):
+        return filenames
+    for exhibit in exhibits:
+        media_url = exhibit.get('mediaUrl') if isinstance(exhibit, dict) else None
+        if not isinstance(media_url, str):
+            continue
+        path = urlsplit(media_url).path
+        if path.startswith(MEDIA_URL_PREFIX):
+            filename = path[len(MEDIA_URL_PREFIX):]
+            if filename and '/' not in filename:
+                filenames.add(filename)
+    return filenames
+
+def _insert_labels(conn: Connection, pairs: list):
+    """Inserts labels and their media references; the caller owns the transaction."""
+    conn.executemany(
+        _SQL_INSERT,
+        [_label_row(label_id, data) for label_id, data in pairs]
+    )
+    conn.executemany(
+        _SQL_INSERT_MEDIA,
+        [(label_id, filename) for label_id, data in pairs for filename in _media_filenames(data)]
+    )
+
+def store_label_data(label_id: str, data: dict) -> bool:
     """Stores the label ID and the JSON data (as a string) into the database."""
     conn = get_db_connection()
     if conn:
         try:
-            # Serialize the Python dictionary into a JSON string
-            json_data = json.dumps(data)
-            
-            conn.execute(
-                "INSERT INTO labels (id, data) VALUES (?, ?)",
-                (label_id, json_data)
-            )
-            conn.commit()
+            conn.execute("BEGIN")
+            _insert_labels(conn, [(label_id, data)])
+            conn.execute("COMMIT")
+            _evict_label(label_id)
+            return True
         except Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
             print(f"Error storing data for ID {label_id}: {e}")
-        finally:
-            conn.close()
+            return False
+    return False
+
+def store_label_data_bulk(pairs: list) -> bool:
+    """Stores many (label ID, data) pairs in a single transaction."""
+    conn = get_db_connection()
+    if conn:
+        try:
+            # One explicit transaction means one commit (and fsync) for the whole batch
+            conn.execute("BEGIN")
+            _insert_labels(conn, pairs)
+            conn.execute("COMMIT")
+            for label_id, _ in pairs:
+                _evict_label(label_id)
+            return True
+        except Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            print(f"Error storing bulk data for {len(pairs)} labels: {e}")
+            return False
+    return False
+
+def _cached_label(label_id: str) -> tuple:
+    """Returns the cached label (or None) and the generation it was read at."""
+    with _label_cache_lock:
+        cached = _label_cache.get(label_id)
+        if cached is not None:
+            _label_cache.move_to_end(label_id)
+        return cached, _label_generation
+
+def _cache_label(label_id: str, data: bytes, generation: int):
+    with _label_cache_lock:
+        if generation != _label_generation:
+            return
+        _label_cache[label_id] = data
+        _label_cache.move_to_end(label_id)
+        if len(_label_cache) > LABEL_CACHE_SIZE:
+            _label_cache.popitem(last=False)
+
+def _cached_summaries() -> tuple:
+    """Returns the cached summary list (or None) and the generation it was read at."""
+    with _summaries_lock:
+        return _summaries_cache, _summaries_generation
+
+def _cache_summaries(summaries: list, generation: int):
+    global _summaries_cache
+    with _summaries_lock:
+        if generation == _summaries_generation:
+            _summaries_cache = summaries
+
+def _summary_from_row(row) -> dict:
+    # Only return necessary fields for the sidebar
+    return {
+        'id': row['id'],
+        'projectTitle': row['title'],
+        'template': row['template']
+    }
+
+def _load_label(conn: Connection, label_id: str) -> dict or None:
+    """Returns a label from the cache or the database; the caller has already synced the caches."""
+    cached, generation = _cached_label(label_id)
+    if cached is not None:
+        # Parsing the cached bytes hands every caller its own dict
+        return _loads_label(cached)
+
+    row = conn.execute(_SQL_SELECT, (label_id,)).fetchone()
+    
+    if row:
+        # Decompress and deserialize the stored JSON back into a Python dictionary
+        label_json = _label_json(row['data'])
+        data = _loads_label(label_json)
+        _cache_label(label_id, label_json, generation)
+        return data
+    return None
+
+def _load_summaries(conn: Connection) -> list:
+    """Returns the sidebar summaries from the cache or the database; the caller has already synced the caches."""
+    cached, generation = _cached_summaries()
+    if cached is None:
+        rows = conn.execute(_SQL_SUMMARY_SELECT).fetchall()
+        cached = [_summary_from_row(row) for row in rows]
+        _cache_summaries(cached, generation)
+    return [dict(summary) for summary in cached]
 
 def get_label_data(label_id: str) -> dict or None:
     """Retrieves and deserializes the JSON data based on the label ID."""
     conn = get_db_connection()
     if conn:
         try:
-            row = conn.execute(
-                "SELECT data FROM labels WHERE id = ?", (label_id,)
-            ).fetchone()
-            
-            if row:
-                # Deserialize the JSON string back into a Python dictionary
-                return json.loads(row['data'])
-            return None
+            _sync_caches()
+            return _load_label(conn, label_id)
         except Error as e:
             print(f"Error retrieving data for ID {label_id}: {e}")
             return None
-        except json.JSONDecodeError as e:
+        except (ValueError, zstandard.ZstdError) as e:
             print(f"Error decoding JSON for ID {label_id}: {e}")
             return None
-        finally:
-            conn.close()
+
+def get_label_qrcode(label_id: str) -> tuple:
+    """Retrieves a label's stored QR code as (url it encodes, data URI), or (None, None)."""
+    conn = get_db_connection()
+    if conn:
+        try:
+            row = conn.execute(_SQL_SELECT_QR, (label_id,)).fetchone()
+            if row:
+                return row['qr_url'], row['qr_png']
+        except Error as e:
+            print(f"Error retrieving QR code for ID {label_id}: {e}")
+    return None, None
+
+def store_label_qrcode(label_id: str, url: str, qr_png: str):
+    """Persists a label's rendered QR code so a cold process can skip regenerating it.
+
+    Does nothing if the label already has a stored code, even for another URL.
+    """
+    conn = get_db_connection()
+    if conn:
+        try:
+            conn.execute(_SQL_UPDATE_QR, (url, qr_png, label_id))
+        except Error as e:
+            print(f"Error storing QR code for ID {label_id}: {e}")
 
 def get_all_label_summaries():
     """Retrieves ID, Project Title, and Template for all stored labels."""
     conn = get_db_connection()
-    summaries = []
     if conn:
         try:
-            rows = conn.execute("SELECT id, data FROM labels ORDER BY created_at DESC").fetchall()
-            
-            for row in rows:
-                data = json.loads(row['data'])
-                # Only return necessary fields for the sidebar
-                summaries.append({
-                    'id': row['id'],
-                    'projectTitle': data.get('projectTitle', 'Untitled Project'),
-                    'template': data.get('template', 'minimalist')
-                })
-            return summaries
+            _sync_caches()
+            return _load_summaries(conn)
         except Error as e:
             print(f"Error retrieving all summaries: {e}")
             return []
-        finally:
-            conn.close()
+    return []
+
+def get_exhibit_plus_sidebar(label_id: str) -> tuple:
+    """Retrieves one label's data together with the sidebar summaries for the exhibit page.
 
-def delete_label_data(label_id: str) -> bool:
-    """Deletes a label entry based on its ID."""
+    Returns (label data or None, summaries). Whatever is already cached is
+    served from memory; when neither is cached both come from a single pass
+    over the labels table that only decodes the requested row.
+    """
     conn = get_db_connection()
     if conn:
+        label_data = None
+        summaries = []
         try:
-            conn.execute("DELETE FROM labels WHERE id = ?", (label_id,))
-            conn.commit()
-            return True
+            _sync_caches()
+            cached_label, label_generation = _cached_label(label_id)
+            cached_summaries, generation = _cached_summaries()
+            if cached_label is not None or cached_summaries is not None:
+                summaries = _load_summaries(conn)
+                try:
+                    label_data = _load_label(conn, label_id)
+                except (ValueError, zstandard.ZstdError) as e:
+                    print(f"Error decoding JSON for ID {label_id}: {e}")
+                return label_data, summaries
+
+            for row in conn.execute(_SQL_EXHIBIT_PLUS_SIDEBAR, (label_id,)):
+                summaries.append(_summary_from_row(row))
+                if row['data'] is not None:
+                    try:
+                        label_json = _label_json(row['data'])
+                        label_data = _loads_label(label_json)
+                        _cache_label(label_id, label_json, label_generation)
+                    except (ValueError, zstandard.ZstdError) as e:
+                        print(f"Error decoding JSON for ID {label_id}: {e}")
+            _cache_summaries(summaries, generation)
         except Error as e:
+            print(f"Error retrieving exhibit {label_id} with summaries: {e}")
+            return None, []
+        return label_data, [dict(summary) for summary in summaries]
+    return None, []
+
+def delete_label_data(label_id: str) -> list or None:
+    """Deletes a label entry based on its ID.
+
+    Returns the uploaded filenames no remaining label references (so the
+    caller can remove them from disk), or None if the deletion failed.
+    """
+    conn = get_db_connection()
+    if conn:
+        try:
+            # Take the write lock up front: a deferred BEGIN would read the orphan
+            # list from a snapshot another writer can invalidate before our DELETE,
+            # failing with SQLITE_BUSY_SNAPSHOT instead of waiting on the busy timeout
+            conn.execute("BEGIN IMMEDIATE")
+            orphaned = [
+                row['filename']
+                for row in conn.execute(_SQL_SELECT_ORPHANED_MEDIA, (label_id, label_id))
+            ]
+            conn.execute(_SQL_DELETE_MEDIA, (label_id,))
+            conn.execute(_SQL_DELETE, (label_id,))
+            conn.execute("COMMIT")
+            _evict_label(label_id)
+            return orphaned
+        except Error as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
             print(f"Error deleting data for ID {label_id}: {e}")
-            return False
-        finally:
-            conn.close()
\ No newline at end of file
+            return None
+
+def is_media_referenced(filename: str) -> bool:
+    """Checks whether any label still points at an uploaded file.
+
+    Errs on the side of keeping the file: returns True if the check fails.
+    """
+    conn = get_db_connection()
+    if conn:
+        try:
+            return conn.execute(_SQL_MEDIA_REFERENCED, (filename,)).fetchone() is not None
+        except Error as e:
+            print(f"Error checking references to media {filename}: {e}")
+    return True
@@ -0,0 +1,21 @@
+# Gunicorn loads this file automatically when started from the app directory:
+#   gunicorn app:app
+import multiprocessing
+import os
+
+wsgi_app = 'app:app'
+bind = os.environ.get('GUNICORN_BIND', '127.0.0.1:8000')
+
+# One worker process per core, each serving requests on a pool of real threads.
+# gthread rather than gevent: SQLite and PNG encoding are C calls that release
+# the GIL but would block a gevent hub, and greenlet-local state would give
+# every request its own SQLite connection instead of one per thread.
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Each worker must import the app itself: connections, caches and the media
+# cleanup thread are all per-process and not fork-safe.
+# The label and sidebar caches stay consistent across workers because every
+# read checks PRAGMA data_version and drops them after another worker's write.
+preload_app = False